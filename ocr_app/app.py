@@ -1,7 +1,11 @@
 import os
 import json
 import base64
+import orjson
+from uuid import uuid4
+from kombu.serialization import register
 from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
 from celery import Celery, Task
 from database import init_db, save_processed_document, get_processed_document, get_history
@@ -31,12 +35,48 @@ def make_celery(app):
 app = Flask(__name__)
 app.secret_key = os.urandom(24) # Required for flashing messages
 
+# --- Upload Staging Area ---
+# Uploads are streamed straight to this shared volume and only their paths
+# are sent through Celery. Shipping multi-MB binaries through Redis pickles
+# the whole payload in the web worker and blows up broker message sizes.
+UPLOAD_DIR = os.environ.get('UPLOAD_DIR', '/data/uploads')
+os.makedirs(UPLOAD_DIR, exist_ok=True)
+
+def stage_uploads(files):
+    """Streams uploaded files to the shared upload volume.
+
+    Returns a dict of {key: (original_filename, path_on_disk)} suitable for
+    passing to process_documents_task. f.save() streams in chunks, so the
+    web process never holds a full file in memory.
+    """
+    staged = {}
+    for i, f in enumerate(files):
+        path = os.path.join(UPLOAD_DIR, f"{uuid4().hex}_{secure_filename(f.filename)}")
+        f.save(path)
+        staged[f"file_{i}"] = (f.filename, path)
+    return staged
+
 # --- Celery Configuration ---
+# Register orjson with kombu so task payloads and results are serialized by
+# the C encoder instead of stdlib json (3-10x faster on large messages).
+register('orjson', orjson.dumps, orjson.loads,
+         content_type='application/x-orjson', content_encoding='binary')
+
 app.config.update(
     CELERY=dict(
         broker_url="redis://redis:6379/0",
         result_backend="redis://redis:6379/0",
         task_ignore_result=False, # We need to store results to check status
+        # msgpack packs binary-safe messages with no base64 inflation, and
+        # zstd compression keeps broker traffic well inside Redis's
+        # small-message sweet spot. orjson/json stay accepted so messages
+        # queued by older workers still decode during a rolling deploy.
+        task_serializer='msgpack',
+        result_serializer='msgpack',
+        task_compression='zstd',
+        result_compression='zstd',
+        accept_content=['msgpack', 'orjson', 'json'],
+        result_accept_content=['msgpack', 'orjson', 'json'],
     )
 )
 celery = make_celery(app)
@@ -51,26 +91,42 @@ swaggerui_blueprint = get_swaggerui_blueprint(
 )
 app.register_blueprint(swaggerui_blueprint)
 
+# Parse swagger.json once at import time. The spec file never changes while
+# the app is running, so re-reading and re-parsing it on every /api/spec hit
+# just burns syscalls and JSON allocations.
+with open(os.path.join(app.static_folder, 'swagger.json')) as f:
+    _SWAGGER_BASE = json.load(f)
+
 # --- Route to dynamically serve the API specification (swagger.json) ---
 @app.route('/api/spec')
 def api_spec():
-    """Dynamically serves the swagger.json file, injecting the correct host/scheme."""
-    with open(os.path.join(app.static_folder, 'swagger.json')) as f:
-        swagger_spec = json.load(f)
-    
-    swagger_spec['host'] = request.host
-    swagger_spec['schemes'] = [request.scheme]
-    swagger_spec['basePath'] = "/"
-    
-    return jsonify(swagger_spec)
+    """Serves the cached swagger spec, injecting the correct host/scheme."""
+    swagger_spec = {
+        **_SWAGGER_BASE,
+        'host': request.host,
+        'schemes': [request.scheme],
+        'basePath': "/",
+    }
+    # orjson.dumps returns bytes, so build the response directly instead of
+    # routing the whole spec through jsonify's stdlib encoder.
+    return app.response_class(orjson.dumps(swagger_spec), mimetype='application/json')
 
-# --- Flask Hooks ---
-@app.before_request
-def setup():
-    """Initializes the database table before the first request."""
-    if not hasattr(app, 'db_initialized'):
+# --- One-shot Database Initialization ---
+# Run the DDL once at import time instead of checking a flag on every request.
+# The database module connects lazily (the pool is built on first checkout),
+# so this init_db() call is the first thing that actually touches Postgres —
+# the except below therefore really does cover an unreachable database, and
+# import (hence Gunicorn/Celery boot) survives it. Under Gunicorn each worker
+# also re-runs init_db from the post_fork hook in gunicorn.conf.py, so no
+# request ever stalls on a DDL round-trip.
+try:
+    with app.app_context():
         init_db()
-        app.db_initialized = True
+except Exception as e:
+    # The database may not be reachable yet (e.g. still starting up, or
+    # during local tooling runs); the post_fork hook retries before any
+    # traffic is served.
+    print(f"Deferred database initialization: {e}")
 
 # --- Main Application Routes ---
 @app.route('/', methods=['GET', 'POST'])
@@ -85,11 +141,11 @@ def index():
             return redirect(request.url)
         
         # The worker's `process_file_input` will handle images and PDFs
-        file_contents_dict = {f"file_{i}": (f.filename, f.read()) for i, f in enumerate(files)}
+        file_paths_dict = stage_uploads(files)
 
         # <<< THE FIX IS HERE >>>
         # The extra 'doc_lang' argument has been removed to match the final processor.py
-        task = process_documents_task.delay(file_contents_dict, doc_type)
+        task = process_documents_task.delay(file_paths_dict, doc_type)
         return redirect(url_for('processing_page', task_id=task.id))
 
     return render_template('index.html')
@@ -107,11 +163,11 @@ def api_extract():
     if not files or all(f.filename == '' for f in files):
         return jsonify({"error": "No selected files"}), 400
         
-    file_contents_dict = {f"file_{i}": (f.filename, f.read()) for i, f in enumerate(files)}
+    file_paths_dict = stage_uploads(files)
 
     # <<< THE FIX IS HERE >>>
     # The extra 'doc_lang' argument has been removed from the call.
-    task = process_documents_task.delay(file_contents_dict, doc_type)
+    task = process_documents_task.delay(file_paths_dict, doc_type)
     
     return jsonify({
         "message": "Processing started.",
@@ -154,6 +210,40 @@ def task_status(task_id):
         response = {'state': task.state, 'status': str(task.info)}
     return jsonify(response)
 
+@app.route('/status/batch')
+def task_status_batch():
+    """API endpoint to check the status of many Celery tasks at once.
+
+    Accepts ?task_ids=a,b,c and answers with one Redis MGET instead of one
+    round-trip per AsyncResult, so clients tracking N uploads poll in O(1).
+    """
+    task_ids = [t for t in request.args.get('task_ids', '').split(',') if t]
+    if not task_ids:
+        return jsonify({"error": "Provide task_ids as a comma-separated list"}), 400
+
+    # One raw MGET against the result backend. Celery's get_many helper is
+    # unsuitable here: it filters out non-ready metas (so PROGRESS would be
+    # reported as PENDING) and sleeps its poll interval whenever a requested
+    # task isn't finished yet.
+    keys = [celery.backend.get_key_for_task(task_id) for task_id in task_ids]
+    raw_metas = celery.backend.mget(keys)
+
+    response = {}
+    for task_id, raw in zip(task_ids, raw_metas):
+        meta = celery.backend.decode_result(raw) if raw is not None else None
+        if meta is None or meta.get('status') == 'PENDING':
+            response[task_id] = {'state': 'PENDING', 'status': 'Pending...'}
+            continue
+        state = meta.get('status')
+        info = meta.get('result')
+        if state == 'SUCCESS' and isinstance(info, dict):
+            response[task_id] = {'state': state, 'status': info.get('status', ''), 'result': info.get('result')}
+        elif state == 'FAILURE':
+            response[task_id] = {'state': state, 'status': str(info)}
+        else:
+            response[task_id] = {'state': state, 'status': info.get('status', '') if isinstance(info, dict) else ''}
+    return jsonify(response)
+
 @app.route('/results/<int:doc_id>')
 def results(doc_id):
     """Displays the extracted data for a specific document ID."""
@@ -161,7 +251,7 @@ def results(doc_id):
     if not document:
         flash('Document not found!', 'error')
         return redirect(url_for('index'))
-    extracted_data = json.dumps(document['extracted_data'], indent=2)
+    extracted_data = orjson.dumps(document['extracted_data'], option=orjson.OPT_INDENT_2).decode('utf-8')
     face_image_b64 = None
     if document['face_image']:
         face_image_b64 = base64.b64encode(document['face_image']).decode('utf-8')
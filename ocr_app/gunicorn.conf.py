@@ -0,0 +1,7 @@
+# Gunicorn configuration. Picked up automatically because it sits in the
+# working directory (/app) that the Dockerfile's CMD runs from.
+
+def post_fork(server, worker):
+    """Ensures the database schema exists before the worker serves traffic."""
+    from database import init_db
+    init_db()